@@ -1,6 +1,12 @@
+import atexit
+import bisect
+import functools
+import io
+import math
 import os
 import sqlite3
-from contextlib import closing
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
 
 from telegram import ReplyKeyboardMarkup, Update
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters
@@ -22,24 +28,62 @@ STATE_ADD_NAME_AMOUNT = "add_name_amount"
 STATE_NEW_DEBT = "new_debt"
 STATE_PAYMENT = "payment"
 
+SQL_INSERT = "INSERT INTO debts(name, total, paid) VALUES (?, ?, 0) ON CONFLICT(name) DO NOTHING"
+SQL_INC = "UPDATE debts SET total = total + ? WHERE name = ? RETURNING total, paid"
+SQL_PAY = (
+    "UPDATE debts SET paid = paid + ?1 WHERE name = ?2 AND paid + ?1 <= total "
+    "RETURNING total, paid"
+)
+SQL_DEL = "DELETE FROM debts WHERE name = ?"
+SQL_LIST_ALL = "SELECT name, total, paid FROM debts ORDER BY name"
+
+_DIGIT_TABLE = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹", "01234567890123456789")
+
+_CONN: sqlite3.Connection | None = None
+_NAMES_LIST: list[str] = []
+_PEOPLE: dict[str, list[float]] = {}
+_NAMES_KB: ReplyKeyboardMarkup | None = None
+
+_MAIN_KB = ReplyKeyboardMarkup([[MAIN_MENU], [ADD_NEW_NAME, LIST_ALL]], resize_keyboard=True)
+_PERSON_KB = ReplyKeyboardMarkup(
+    [[NEW_DEBT, PAYMENT], [STATUS, DELETE_PERSON], [BACK]],
+    resize_keyboard=True,
+)
+
 
 def normalize_digits(value: str) -> str:
-    table = str.maketrans("٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷８٩", "01234567890123456789")
-    return value.translate(table)
+    return value.translate(_DIGIT_TABLE)
 
 def init_db() -> None:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS debts (
-                name TEXT PRIMARY KEY,
-                total REAL NOT NULL,
-                paid REAL NOT NULL DEFAULT 0
-            )
-            """
+    global _CONN, _NAMES_KB
+    if _CONN is not None:
+        return
+    if sqlite3.sqlite_version_info < (3, 35, 0):
+        raise RuntimeError(f"SQLite 3.35+ required (RETURNING), found {sqlite3.sqlite_version}")
+    _CONN = sqlite3.connect(DB_PATH, isolation_level=None)
+    atexit.register(_CONN.close)
+    _CONN.execute("PRAGMA journal_mode=WAL")
+    _CONN.execute("PRAGMA synchronous=NORMAL")
+    _CONN.execute("PRAGMA temp_store=MEMORY")
+    _CONN.execute("PRAGMA cache_size=-64000")
+    _CONN.execute("PRAGMA busy_timeout=5000")
+    _CONN.execute(
+        """
+        CREATE TABLE IF NOT EXISTS debts (
+            name TEXT PRIMARY KEY,
+            total REAL NOT NULL,
+            paid REAL NOT NULL DEFAULT 0
         )
-        conn.commit()
+        """
+    )
+    _PEOPLE.clear()
+    _PEOPLE.update(
+        (name, [float(total), float(paid)]) for name, total, paid in _CONN.execute(SQL_LIST_ALL)
+    )
+    _NAMES_LIST[:] = _PEOPLE
+    _NAMES_KB = None
 
+@functools.lru_cache(maxsize=1)
 def load_token() -> str:
     token = (os.getenv("TELEGRAM_BOT_TOKEN") or "").strip()
     if token:
@@ -54,74 +98,90 @@ def load_token() -> str:
     raise RuntimeError("Telegram token not found. Set TELEGRAM_BOT_TOKEN or create bot_token.txt")
 
 def get_names() -> list[str]:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        rows = conn.execute("SELECT name FROM debts ORDER BY name").fetchall()
-    return [row[0] for row in rows]
+    return _NAMES_LIST
 
-def get_person(name: str) -> tuple[float, float] | None:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        row = conn.execute("SELECT total, paid FROM debts WHERE name=?", (name,)).fetchone()
-    if not row:
-        return None
-    return float(row[0]), float(row[1])
+def _conn() -> sqlite3.Connection:
+    if _CONN is None:
+        raise RuntimeError("init_db() not called")
+    return _CONN
+
+@contextmanager
+def tx() -> Iterator[sqlite3.Connection]:
+    conn = _conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
 
 def add_new_person(name: str, amount: float) -> bool:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        exists = conn.execute("SELECT 1 FROM debts WHERE name=?", (name,)).fetchone()
-        if exists:
-            return False
-        conn.execute("INSERT INTO debts(name, total, paid) VALUES (?, ?, 0)", (name, amount))
-        conn.commit()
+    global _NAMES_KB
+    with tx() as conn:
+        inserted = conn.execute(SQL_INSERT, (name, amount)).rowcount == 1
+    if not inserted:
+        return False
+    bisect.insort(_NAMES_LIST, name)
+    _PEOPLE[name] = [amount, 0.0]
+    _NAMES_KB = None
     return True
 
-def increase_debt(name: str, amount: float) -> None:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute("UPDATE debts SET total = total + ? WHERE name = ?", (amount, name))
-        conn.commit()
+def increase_debt(name: str, amount: float) -> tuple[float, float] | None:
+    with tx() as conn:
+        row = conn.execute(SQL_INC, (amount, name)).fetchone()
+    if not row:
+        return None
+    total, paid = float(row[0]), float(row[1])
+    _PEOPLE[name] = [total, paid]
+    return total, paid
 
 def add_payment(name: str, amount: float) -> tuple[bool, float]:
-    person = get_person(name)
-    if not person:
-        return False, 0.0
-
-    total, paid = person
-    new_paid = paid + amount
-    if new_paid > total:
+    with tx() as conn:
+        row = conn.execute(SQL_PAY, (amount, name)).fetchone()
+    if not row:
+        total, paid = _PEOPLE.get(name, (0.0, 0.0))
         return False, total - paid
-
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        conn.execute("UPDATE debts SET paid = ? WHERE name = ?", (new_paid, name))
-        conn.commit()
-    return True, total - new_paid
+    total, paid = float(row[0]), float(row[1])
+    _PEOPLE[name] = [total, paid]
+    return True, total - paid
 
 def delete_person(name: str) -> bool:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        cur = conn.execute("DELETE FROM debts WHERE name = ?", (name,))
-        conn.commit()
-    return cur.rowcount > 0
+    global _NAMES_KB
+    with tx() as conn:
+        deleted = conn.execute(SQL_DEL, (name,)).rowcount > 0
+    if deleted and name in _PEOPLE:
+        del _PEOPLE[name]
+        _NAMES_LIST.remove(name)
+        _NAMES_KB = None
+    return deleted
 
 def parse_amount(text: str) -> float | None:
+    value = text.strip()
+    if not value.isascii():
+        value = normalize_digits(value)
     try:
-        amount = float(normalize_digits(text.strip()))
+        amount = float(value)
     except ValueError:
         return None
-    if amount <= 0:
+    if not math.isfinite(amount) or amount <= 0:
         return None
     return amount
 
 def main_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup([[MAIN_MENU], [ADD_NEW_NAME, LIST_ALL]], resize_keyboard=True)
+    return _MAIN_KB
 
-def names_keyboard(names: list[str]) -> ReplyKeyboardMarkup:
-    rows = [[name] for name in names]
-    rows.append([BACK])
-    return ReplyKeyboardMarkup(rows, resize_keyboard=True)
+def names_keyboard() -> ReplyKeyboardMarkup:
+    global _NAMES_KB
+    if _NAMES_KB is None:
+        rows = [[name] for name in _NAMES_LIST]
+        rows.append([BACK])
+        _NAMES_KB = ReplyKeyboardMarkup(rows, resize_keyboard=True)
+    return _NAMES_KB
 
 def person_actions_keyboard() -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        [[NEW_DEBT, PAYMENT], [STATUS, DELETE_PERSON], [BACK]],
-        resize_keyboard=True,
-    )
+    return _PERSON_KB
 
 async def show_main_menu(update: Update) -> None:
     await update.message.reply_text(
@@ -134,19 +194,114 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await show_main_menu(update)
 
 async def show_all(update: Update) -> None:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        rows = conn.execute("SELECT name, total, paid FROM debts ORDER BY name").fetchall()
-    if not rows:
+    buf = io.StringIO()
+    for name, total, paid in _conn().execute(SQL_LIST_ALL):
+        if buf.tell():
+            buf.write("\n")
+        buf.write(name)
+        buf.write(" - المتبقي: ")
+        buf.write(format(total - paid, "g"))
+    if not buf.tell():
         await update.message.reply_text("لا توجد ديون.")
         return
-    lines = [f"{name} - المتبقي: {total - paid:g}" for name, total, paid in rows]
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(buf.getvalue())
+
+async def _handle_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.clear()
+    await show_main_menu(update)
+
+async def _handle_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    names = get_names()
+    if not names:
+        await update.message.reply_text(
+            "القائمة فارغة. أضف اسم جديد أولاً."
+        )
+        return
+    await update.message.reply_text(
+        "اختر الاسم:",
+        reply_markup=names_keyboard(),
+    )
+
+async def _handle_add_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data.clear()
+    context.user_data["pending"] = STATE_ADD_NAME
+    await update.message.reply_text("اكتب الاسم الجديد:")
+
+async def _handle_list_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await show_all(update)
+
+async def _handle_new_debt_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    selected_name = context.user_data.get("selected_name")
+    if not selected_name:
+        await update.message.reply_text(
+            "اختر اسم أولاً من قائمة الأسماء."
+        )
+        return
+    context.user_data["pending"] = STATE_NEW_DEBT
+    await update.message.reply_text(
+        f"اكتب مبلغ الدين الجديد لـ {selected_name}:")
+
+async def _handle_payment_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    selected_name = context.user_data.get("selected_name")
+    if not selected_name:
+        await update.message.reply_text(
+            "اختر اسم أولاً من قائمة الأسماء."
+        )
+        return
+    context.user_data["pending"] = STATE_PAYMENT
+    await update.message.reply_text(
+        f"اكتب مبلغ السداد لـ {selected_name}:")
+
+async def _handle_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    selected_name = context.user_data.get("selected_name")
+    if not selected_name:
+        await update.message.reply_text(
+            "اختر اسم أولاً من قائمة الأسماء."
+        )
+        return
+    person = _PEOPLE.get(selected_name)
+    if not person:
+        await update.message.reply_text("الاسم غير موجود.")
+        return
+    total, paid = person
+    await update.message.reply_text(
+        f"{selected_name}\n"
+        f"إجمالي: {total:g}\n"
+        f"مدفوع: {paid:g}\n"
+        f"متبقي: {total - paid:g}",
+        reply_markup=person_actions_keyboard(),
+    )
+
+async def _handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    selected_name = context.user_data.get("selected_name")
+    if not selected_name:
+        await update.message.reply_text(
+            "اختر اسم أولاً من قائمة الأسماء."
+        )
+        return
+    if delete_person(selected_name):
+        context.user_data.clear()
+        await update.message.reply_text(
+            f"تم حذف {selected_name} من القائمة.",
+            reply_markup=main_keyboard(),
+        )
+        return
+    await update.message.reply_text("الاسم غير موجود.")
+
+_BUTTON_HANDLERS: dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[None]]] = {
+    MAIN_MENU: _handle_main_menu,
+    ADD_NEW_NAME: _handle_add_new,
+    LIST_ALL: _handle_list_all,
+    NEW_DEBT: _handle_new_debt_btn,
+    PAYMENT: _handle_payment_btn,
+    STATUS: _handle_status,
+    DELETE_PERSON: _handle_delete,
+}
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (update.message.text or "").strip()
     if text == BACK:
-        context.user_data.clear()
-        await show_main_menu(update)
+        await _handle_back(update, context)
         return
     pending = context.user_data.get("pending")
     selected_name = context.user_data.get("selected_name")
@@ -154,6 +309,9 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         if not text:
             await update.message.reply_text("اكتب اسم صحيح.")
             return
+        if text == BACK or text in _BUTTON_HANDLERS:
+            await update.message.reply_text("هذا الاسم محجوز لزر في القائمة. اكتب اسم آخر.")
+            return
         context.user_data["pending"] = STATE_ADD_NAME_AMOUNT
         context.user_data["draft_name"] = text
         await update.message.reply_text(
@@ -171,14 +329,17 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             context.user_data.clear()
             await show_main_menu(update)
             return
+        context.user_data.clear()
         if not add_new_person(name, amount):
-            await update.message.reply_text("الاسم موجود مسبقاً.")
+            await update.message.reply_text(
+                "الاسم موجود مسبقاً.",
+                reply_markup=main_keyboard(),
+            )
         else:
             await update.message.reply_text(
-                f"تم تسجيل دين {name} بمبلغ {amount:g}"
+                f"تم تسجيل دين {name} بمبلغ {amount:g}",
+                reply_markup=main_keyboard(),
             )
-        context.user_data.clear()
-        await show_main_menu(update)
         return
     if pending == STATE_NEW_DEBT and selected_name:
         amount = parse_amount(text)
@@ -187,8 +348,7 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 "المبلغ غير صحيح. اكتب رقم موجب."
             )
             return
-        increase_debt(selected_name, amount)
-        total, paid = get_person(selected_name) or (0.0, 0.0)
+        total, paid = increase_debt(selected_name, amount) or (0.0, 0.0)
         await update.message.reply_text(
             f"تمت إضافة دين جديد لـ {selected_name} بمبلغ {amount:g}\n"
             f"المتبقي الآن: {total - paid:g}",
@@ -217,28 +377,11 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         )
         context.user_data["pending"] = None
         return
-    if text == MAIN_MENU:
-        names = get_names()
-        if not names:
-            await update.message.reply_text(
-                "القائمة فارغة. أضف اسم جديد أولاً."
-            )
-            return
-        await update.message.reply_text(
-            "اختر الاسم:",
-            reply_markup=names_keyboard(names),
-        )
-        return
-    if text == ADD_NEW_NAME:
-        context.user_data.clear()
-        context.user_data["pending"] = STATE_ADD_NAME
-        await update.message.reply_text("اكتب الاسم الجديد:")
+    handler = _BUTTON_HANDLERS.get(text)
+    if handler:
+        await handler(update, context)
         return
-    if text == LIST_ALL:
-        await show_all(update)
-        return
-    names = get_names()
-    if text in names:
+    if text in _PEOPLE:
         context.user_data["selected_name"] = text
         context.user_data["pending"] = None
         await update.message.reply_text(
@@ -246,60 +389,6 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             reply_markup=person_actions_keyboard(),
         )
         return
-    if text == NEW_DEBT:
-        if not selected_name:
-            await update.message.reply_text(
-                "اختر اسم أولاً من قائمة الأسماء."
-            )
-            return
-        context.user_data["pending"] = STATE_NEW_DEBT
-        await update.message.reply_text(
-            f"اكتب مبلغ الدين الجديد لـ {selected_name}:")
-        return
-    if text == PAYMENT:
-        if not selected_name:
-            await update.message.reply_text(
-                "اختر اسم أولاً من قائمة الأسماء."
-            )
-            return
-        context.user_data["pending"] = STATE_PAYMENT
-        await update.message.reply_text(
-            f"اكتب مبلغ السداد لـ {selected_name}:")
-        return
-    if text == STATUS:
-        if not selected_name:
-            await update.message.reply_text(
-                "اختر اسم أولاً من قائمة الأسماء."
-            )
-            return
-        person = get_person(selected_name)
-        if not person:
-            await update.message.reply_text("الاسم غير موجود.")
-            return
-        total, paid = person
-        await update.message.reply_text(
-            f"{selected_name}\n"
-            f"إجمالي: {total:g}\n"
-            f"مدفوع: {paid:g}\n"
-            f"متبقي: {total - paid:g}",
-            reply_markup=person_actions_keyboard(),
-        )
-        return
-    if text == DELETE_PERSON:
-        if not selected_name:
-            await update.message.reply_text(
-                "اختر اسم أولاً من قائمة الأسماء."
-            )
-            return
-        if delete_person(selected_name):
-            context.user_data.clear()
-            await update.message.reply_text(
-                f"تم حذف {selected_name} من القائمة."
-            )
-            await show_main_menu(update)
-            return
-        await update.message.reply_text("الاسم غير موجود.")
-        return
     await update.message.reply_text(
         "غير مفهوم. اختر من الأزرار المعروضة."
     )